@@ -1,7 +1,19 @@
 import numpy as np
 import logging as log
+import os
+import multiprocessing
+import itertools
+import hashlib
+import json
+import pathlib
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import requests
 import pandas as pd
+import matplotlib
+if os.environ.get('HEADLESS'):
+    matplotlib.use('Agg') #no display available, skip the interactive backend
 import matplotlib.pyplot as plt
 import seaborn as sns
 import matplotlib.dates as mdates
@@ -11,9 +23,30 @@ from windpowerlib import data as wt
 log.getLogger().setLevel(log.INFO)
 log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
 
+FORECAST_CACHE_TTL = 30 * 60  # forecast responses younger than this are served from disk, s
+FORECAST_CACHE_DIR = pathlib.Path(os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache') / 'WindProduction'
+SESSION = requests.Session()  # keeps the connection to the weather API alive between requests
+MODELCHAIN_DATA = {
+    'wind_speed_model': 'logarithmic',      # 'logarithmic' (default),'hellman' or 'interpolation_extrapolation'
+    'density_model': 'barometric',           # 'barometric' (default), 'ideal_gas' or 'interpolation_extrapolation'
+    'temperature_model': 'linear_gradient', # 'linear_gradient' (def.) or 'interpolation_extrapolation'
+    'power_output_model':
+        'power_curve',          # 'power_curve' (default) or 'power_coefficient_curve'
+    'density_correction': False,             # False (default) or True
+    'obstacle_height': 0,                   # default: 0
+    'hellman_exp': None}                    # None (default) or None
+POOL_MIN_TURBINES = 16  # fewer remaining turbines are modelled in-process, see use_process_pool
+PLOT_FILE = 'power_production.png'  # where the plot is saved when running with HEADLESS set
+POWER_CURVES_FILE = os.path.join(os.path.dirname(wt.__file__), 'oedb', 'power_curves.csv')  # windpowerlib library
+FORECAST_COLUMNS = pd.MultiIndex.from_tuples([('wind_speed', 10), ('pressure', 0), ('temperature', 2),
+                                               ('roughness_length', 0), ('wind_speed', 100)],
+                                              names=('variable', 'height'))  # weather data layout expected by windpowerlib
+
 def get_forecast(lat: float, lon:float, API_key:str):
     """
-    Get hourly forecast for 48 hrs from Openweathermap API for chosen location
+    Get hourly forecast for 48 hrs from Openweathermap API for chosen location.
+    Responses are cached on disk and reused for FORECAST_CACHE_TTL seconds after download. The cache is only an
+    optimisation: if it cannot be read or written, the forecast is downloaded and returned anyway
 
     :param lat: latitude of place for which getting forecast, degrees
     :param lon: longitude of place for which getting forecast, degrees
@@ -21,26 +54,62 @@ def get_forecast(lat: float, lon:float, API_key:str):
     :return: list of hourly forecast for the following 48 hrs
     """
 
+    cache_key = hashlib.sha1(f"{lat:.4f}_{lon:.4f}".encode()).hexdigest()
+    cache_path = FORECAST_CACHE_DIR / f"owm_{cache_key}.json"
+
+    try:
+        if time.time() - cache_path.stat().st_mtime < FORECAST_CACHE_TTL:
+            log.debug(f"Reading cached forecast from {cache_path}")
+            return json.loads(cache_path.read_text())['hourly']
+    except FileNotFoundError:
+        pass #no cached forecast for this location
+    except (OSError, ValueError, KeyError) as error:
+        log.warning(f"Cached forecast {cache_path} cannot be read ({error!r}), getting a new one")
+
     log.debug(f"Getting hourly 48 hrs forecast for the coordinates lat: {round(lat,2)} lon: {round(lon,2)}")
 
-    response: requests.Response = requests.get(f"https://api.openweathermap.org/data/2.5/onecall?lat={lat}&lon={lon}&exclude=current,minutely,daily,alerts&appid={API_key}")
+    response: requests.Response = SESSION.get(f"https://api.openweathermap.org/data/2.5/onecall?lat={lat}&lon={lon}&exclude=current,minutely,daily,alerts&appid={API_key}",
+                                              timeout=10)
     log.debug(f"The response from the server: {response.status_code}")
     forecast =  response.json()['hourly']
+    try:
+        save_forecast_cache(cache_path, response.text)
+    except OSError as error:
+        log.warning(f"Could not save the forecast to the cache ({error!r})")
 
     return forecast
 
+def save_forecast_cache(cache_path: pathlib.Path, response_text: str):
+    """
+    Atomically save forecast response to the cache and remove expired cache files
+    :param cache_path: path of the cache file for the location
+    :param response_text: raw response from the weather API
+    :return: None
+    """
+    FORECAST_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=FORECAST_CACHE_DIR, suffix='.tmp', delete=False) as cache_file:
+        cache_file.write(response_text)
+    os.replace(cache_file.name, cache_path) #readers never see a partially written file
+
+    for old_path in itertools.chain(FORECAST_CACHE_DIR.glob('owm_*.json'), FORECAST_CACHE_DIR.glob('*.tmp')):
+        try:
+            if time.time() - old_path.stat().st_mtime > FORECAST_CACHE_TTL:
+                old_path.unlink()
+        except OSError:
+            pass #removed by another run in the meantime or not ours to remove
+
 def clean_data(forecast: list):
     """
     Converts input data to df and gets only relevant data for predicting wind production
     :param forecast: list of predictions for each hour in the following 48 hrs
     :return: clean dataframe
     """
-    df_forecast = pd.DataFrame(forecast)
-    df_forecast['dt'] = pd.to_datetime(df_forecast['dt'], unit='s')
-    df_forecast = df_forecast.set_index(['dt'], drop=True)
-    df_forecast = df_forecast[['wind_speed', 'pressure', 'temp']]
+    df_forecast = pd.DataFrame.from_records(forecast, columns=['dt', 'wind_speed', 'pressure', 'temp'])
+    df_forecast['dt'] = pd.to_datetime(df_forecast['dt'].to_numpy(), unit='s')
+    df_forecast.set_index('dt', drop=True, inplace=True)
     df_forecast['pressure'] = df_forecast['pressure'].mul(100) #convert to Pa
     df_forecast = df_forecast.rename(columns= {'temp': 'temperature'})
+    df_forecast = df_forecast.astype(np.float32) #single precision is plenty for weather data
 
     return df_forecast
 
@@ -59,13 +128,11 @@ def calculate_vertical_wind_distribution(roughness_coefficient:float, height_rot
     """
 
     log.debug("Recalculating forecasted wind speed at anemometer height to wind speed at rotor height")
+    height_factor = np.float32((height_rotor/height_forecast) ** roughness_coefficient)
     forecast_velocity['roughness_length'] = roughness_coefficient
-    forecast_velocity['wind_speed_100'] = forecast_velocity['wind_speed']* pow((height_rotor/height_forecast)
-                                                                                         ,roughness_coefficient)
+    forecast_velocity['wind_speed_100'] = forecast_velocity['wind_speed'].to_numpy() * height_factor
 
-    arrays = [['wind_speed', 'pressure', 'temperature', 'roughness_length', 'wind_speed_100'],[10,0,2,0,100]]
-    forecast_velocity.columns = pd.MultiIndex.from_arrays(arrays, names=('variable', 'height'))
-    forecast_velocity = forecast_velocity.rename(columns= {'wind_speed_100': 'wind_speed'})
+    forecast_velocity.columns = FORECAST_COLUMNS
 
     return forecast_velocity
 
@@ -80,35 +147,115 @@ def get_turbine_library():
 
 def iterate_turbine_library(turbine_database: pd.DataFrame, weather_forecast: pd.DataFrame):
     """
-    Function iterating over all the turbines available in the database, calculating power output for given forecast
+    Function iterating over all the turbines available in the database, calculating power output for given forecast.
+    Turbines are modelled in order of decreasing peak power and those whose peak power cannot reach the best energy
+    found so far are skipped. When many turbines remain, they are modelled in parallel (see run_in_process_pool)
     :param turbine_database: dataframe with all the turbines available in the database
     :param weather_forecast: dataframe with hourly weather forecast
     :return: None
     """
-    results = []
-    for index, row in turbine_database.iterrows():
-        result_dict = {}
-        turbine = initialize_wind_turbine(row['turbine_type'])
-        results_turbine = calculate_power_output(turbine, weather_forecast)
-        result_dict['turbine_type'] = row['turbine_type']
-        result_dict['power_output_hourly'] = results_turbine.power_output
-        result_dict['energy_produced_kWh'] = round(results_turbine.power_output.sum(),2)
-        results.append(result_dict)
-
+    turbine_types = turbine_database['turbine_type'].to_numpy()
+    peak_power = get_peak_power(turbine_types)
+    order = np.argsort(-peak_power, kind='stable')
+    energy_bounds = np.round(peak_power[order] * len(weather_forecast) / 1000, 2) #upper bound of produced energy, kWh
+
+    results_by_idx = {}
+    best_energy = -np.inf
+    position = 0
+    while position < len(order) and energy_bounds[position] >= best_energy:
+        remaining = np.count_nonzero(energy_bounds[position:] >= best_energy) #bounds are sorted, so it is a prefix
+        if results_by_idx and use_process_pool(remaining):
+            best_energy = run_in_process_pool(turbine_types, order[position:position + remaining],
+                                              energy_bounds[position:position + remaining], weather_forecast,
+                                              results_by_idx, best_energy)
+            break
+        result = calculate_turbine_energy(turbine_types[order[position]], weather_forecast)
+        results_by_idx[order[position]] = result
+        best_energy = max(best_energy, result['energy_produced_kWh'])
+        position += 1
+    log.debug(f"Skipped {len(order) - len(results_by_idx)} turbines which cannot reach {best_energy} kWh")
+
+    results = [results_by_idx[idx] for idx in sorted(results_by_idx)] #database order, so ties go to the first turbine
     max_idx = find_maximum_power(results)
+    best_turbine = calculate_power_output(initialize_wind_turbine(results[max_idx]['turbine_type']), weather_forecast)
+    results[max_idx]['power_output_hourly'] = best_turbine.power_output
     plot_power_production(results[max_idx], weather_forecast)
 
+def use_process_pool(turbines_count: int):
+    """
+    Decide if modelling turbines in worker processes is worth starting a pool. A turbine takes ~12-23 ms in-process,
+    while a pool starts in ~6 ms with 'fork' but ~750 ms with 'spawn' (Windows, macOS), which is more than modelling
+    the whole turbine library in-process
+    :param turbines_count: number of turbines left to model
+    :return: True if the turbines should be modelled in a process pool
+    """
+    return ((os.cpu_count() or 1) > 1 and multiprocessing.get_start_method() == 'fork'
+            and turbines_count >= POOL_MIN_TURBINES)
+
+def run_in_process_pool(turbine_types: np.ndarray, candidates: np.ndarray, energy_bounds: np.ndarray,
+                        weather_forecast: pd.DataFrame, results_by_idx: dict, best_energy: float):
+    """
+    Model candidate turbines in parallel, keeping one turbine per worker running and skipping the ones whose upper
+    bound of energy falls below the best energy found so far
+    :param turbine_types: names of all turbines in the database
+    :param candidates: database positions of turbines to model, in order of decreasing peak power
+    :param energy_bounds: upper bound of produced energy for each candidate, kWh
+    :param weather_forecast: dataframe with hourly weather forecast
+    :param results_by_idx: results of already modelled turbines by database position, updated in place
+    :param best_energy: best energy found so far, kWh
+    :return: best energy found, kWh
+    """
+    workers = min(os.cpu_count() or 1, len(candidates))
+    running = {}
+    position = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while position < len(candidates) and len(running) < workers and energy_bounds[position] >= best_energy:
+                future = executor.submit(calculate_turbine_energy, turbine_types[candidates[position]],
+                                         weather_forecast)
+                running[future] = candidates[position]
+                position += 1
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results_by_idx[running.pop(future)] = result
+                best_energy = max(best_energy, result['energy_produced_kWh'])
+
+    return best_energy
+
+def get_peak_power(turbine_types: np.ndarray):
+    """
+    Get the maximum power from the power curves of selected turbine types, read at once from the windpowerlib library
+    :param turbine_types: names of turbines
+    :return: maximum power on the power curve of each turbine, W; infinite if the power curve is not found
+    """
+    power_curves = pd.read_csv(POWER_CURVES_FILE, index_col=0)
+    peak_power = power_curves.max(axis=1).reindex(turbine_types).to_numpy(dtype=np.float64)
+
+    return np.nan_to_num(peak_power, nan=np.inf)
+
+def calculate_turbine_energy(turbine_type: str, weather_forecast: pd.DataFrame):
+    """
+    Calculate energy produced by a single turbine type in the forecasted conditions.
+    Hourly power output is not returned to keep the data sent back from worker processes small
+    :param turbine_type: name of turbine
+    :param weather_forecast: dataframe with hourly weather forecast
+    :return: dictionary with turbine type and produced energy, kWh
+    """
+    turbine = calculate_power_output(initialize_wind_turbine(turbine_type), weather_forecast)
+
+    return {'turbine_type': turbine_type, 'energy_produced_kWh': round(turbine.power_output.sum(),2)}
+
 def initialize_wind_turbine(turbine_type):
     """
     Initialize parameters of turbine from database with given turbine type
     :param turbine_type: name of turbine
     :return: turbine parameters
     """
-    turbine_args = {
-        'turbine_type': turbine_type,  # turbine type as in oedb turbine library
-        'hub_height': 120
-    }
-    turbine = WindTurbine(**turbine_args)
+    turbine = WindTurbine(turbine_type=turbine_type,  # turbine type as in oedb turbine library
+                          hub_height=120)
 
     return turbine
 
@@ -120,35 +267,23 @@ def calculate_power_output(turbine, weather_forecast):
     :return: hourly power output from selected turbine, in KW
     """
 
-    modelchain_data = {
-        'wind_speed_model': 'logarithmic',      # 'logarithmic' (default),'hellman' or 'interpolation_extrapolation'
-        'density_model': 'barometric',           # 'barometric' (default), 'ideal_gas' or 'interpolation_extrapolation'
-        'temperature_model': 'linear_gradient', # 'linear_gradient' (def.) or 'interpolation_extrapolation'
-        'power_output_model':
-            'power_curve',          # 'power_curve' (default) or 'power_coefficient_curve'
-        'density_correction': False,             # False (default) or True
-        'obstacle_height': 0,                   # default: 0
-        'hellman_exp': None}                    # None (default) or None
-
-    model_turbine = ModelChain(turbine, **modelchain_data).run_model(weather_forecast)
+    model_turbine = ModelChain(turbine, **MODELCHAIN_DATA).run_model(weather_forecast)
     turbine.power_output = model_turbine.power_output/1000 #return hourly power output in kW
 
-    #print(f"Calculated power output for {turbine.turbine_type} is {round(turbine.power_output.sum(),2)} kWh")
-
     return turbine
 
 def find_maximum_power(results: list):
     """
     Function returning parameters of the turbine giving the maximum output in selected conditions
     :param results: list with all predicted power outputs for turbines in the database
-    :return: None
+    :return: index of the turbine with the maximum output in results
     """
-    results = [{k: v for k, v in d.items() if k != 'power_output_hourly'} for d in results]
-    df_results = pd.DataFrame(results)
+    energies = np.fromiter((result['energy_produced_kWh'] for result in results), dtype=np.float64,
+                           count=len(results))
 
-    max_power_idx = df_results['energy_produced_kWh'].idxmax()
-    print(f"The turbine with the greatest power output is {df_results['turbine_type'].iloc[max_power_idx]} "
-          f"and would produce {round(df_results['energy_produced_kWh'].iloc[max_power_idx]/1000,2)} MWh of electric energy"
+    max_power_idx = int(energies.argmax())
+    print(f"The turbine with the greatest power output is {results[max_power_idx]['turbine_type']} "
+          f"and would produce {round(energies[max_power_idx]/1000,2)} MWh of electric energy"
           f" in the upcoming 4 days")
 
     return max_power_idx
@@ -180,7 +315,12 @@ def plot_power_production(wind_production: dict, forecast: pd.DataFrame):
     ax[1].xaxis.set_major_locator(hours)
     ax[1].xaxis.set_major_formatter(h_fmt)
     fig.autofmt_xdate(rotation=45)
-    plt.show()
+    if os.environ.get('HEADLESS'):
+        fig.savefig(PLOT_FILE, bbox_inches='tight')
+        log.info(f"Saved the plot to {os.path.abspath(PLOT_FILE)}")
+    else:
+        plt.show()
+    plt.close(fig)
 
 if __name__ == "__main__":
     forecast_list  = get_forecast(54.335472056066855, 16.564964098411, "ccabb6fe85ca3bac888578fe83955ed2")